@@ -158,3 +158,31 @@ class PhotometricFilters(object):
         
         self.columns = my_cols
         self.data = Table(my_cols)
+
+        # Filter metadata used when plotting, computed once here. The bands are
+        # sorted by effective wavelength through `sort_index`, and `delta_wl`
+        # contains the separation between adjacent (sorted) bands, with the
+        # first element repeated
+        _wl_eff = np.asarray(self.data['wl_eff'], dtype=np.float64)
+        self.sort_index = np.argsort(_wl_eff)
+        self.sorted_wl_eff = _wl_eff[self.sort_index]
+        self.sorted_log_wl_eff = np.log10(self.sorted_wl_eff)
+        self.delta_wl = self._delta_wl(self.sorted_wl_eff)
+        self.log_delta_wl = self._delta_wl(self.sorted_log_wl_eff)
+        self.min_rel_err = np.asarray(self.data['min_rel_err'], dtype=np.float32)
+
+        # Names of the catalogue flux (and flux error) columns, and of the
+        # BEAGLE model flux columns, of each band, as plain tuples of strings
+        # which are faster to index than the Table columns
+        self.flux_cols = tuple(str(name) for name in self.data['flux_colName'])
+        self.err_cols = tuple(str(name) for name in self.data['flux_errcolName'])
+        self.model_cols = tuple('_' + str(lab) + '_' for lab in self.data['label'])
+
+    @staticmethod
+    def _delta_wl(wl):
+
+        if len(wl) < 2:
+            return np.ones(len(wl))
+
+        delta_wl = wl[1:]-wl[0:-1]
+        return np.concatenate(([delta_wl[0]], delta_wl))
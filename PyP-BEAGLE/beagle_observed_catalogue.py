@@ -1,9 +1,9 @@
 from astropy.io import ascii
 from astropy.io import fits
 
-from beagle_utils import is_FITS_file
+from beagle_utils import is_FITS_file, RowIndexedTable
         
-class ObservedCatalogue(object):
+class ObservedCatalogue(RowIndexedTable):
 
     def load(self, file_name):
 
@@ -18,9 +18,10 @@ class ObservedCatalogue(object):
         """
 
         if is_FITS_file(file_name):
-            self.data = fits.open(file_name)[1].data
-            self.columns = fits.open(file_name)[1].columns
+            hdu = fits.open(file_name, memmap=True)[1]
+            self.data = hdu.data
+            self.columns = hdu.columns
         else:
             self.data = ascii.read(file_name, Reader=ascii.basic.CommentedHeader)
 
-
+        self.reset_row_index()
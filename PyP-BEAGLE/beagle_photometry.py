@@ -1,11 +1,14 @@
 import logging
 import os
+from functools import partial
 from scipy.interpolate import interp1d
 from collections import OrderedDict
 from bisect import bisect_left
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as plticker
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 #import pandas as pd
 # SEABORN creates by default plots with a filled background!!
 #import seaborn as sns
@@ -14,10 +17,12 @@ from astropy.io import fits
 
 import sys
 import dependencies.WeightedKDE as WeightedKDE
+from pathos.multiprocessing import ProcessingPool
 from dependencies.walker_random_sampling import WalkerRandomSampling
 
 from beagle_utils import BeagleDirectories, prepare_plot_saving, set_plot_ticks, \
-        prepare_violin_plot, plot_exists, pause, extract_row, is_FITS_file
+        prepare_violin_plot, prepare_violin_plot_batch, plot_exists, pause, \
+        is_FITS_file, open_BEAGLE_results, open_FITS_file, close_BEAGLE_results
 from beagle_filters import PhotometricFilters
 from beagle_summary_catalogue import BeagleSummaryCatalogue
 from beagle_residual_photometry import ResidualPhotometry
@@ -35,6 +40,111 @@ p_value_lim = 0.05
 
 
 
+# Flux extractors, keyed by the filter configuration they were built for
+_flux_extractors = dict()
+
+def _make_flux_extractor(flux_cols, err_cols, units, min_rel_err):
+    """ 
+    Build a function extracting, from a catalogue row, the fluxes and flux
+    errors (units are Jy) of a given set of bands.
+
+    Parameters
+    ----------
+    flux_cols : tuple
+        Names of the flux columns (an empty name means that the band has no
+        flux column).
+
+    err_cols : tuple
+        Names of the flux error columns.
+
+    units : float
+        Units of the catalogue fluxes, in erg/s/cm^2/Hz.
+
+    min_rel_err : tuple
+        Minimum relative error of each band.
+
+    Returns
+    -------
+    extract : function
+        Takes a catalogue row and an aperture correction, and returns the
+        flux and flux_error arrays.
+    """
+
+    n_bands = len(flux_cols)
+    has_flux = np.array([bool(name) for name in flux_cols], dtype=bool)
+
+    _flux_cols = [name for name, has in zip(flux_cols, has_flux) if has]
+    _err_cols = [name for name, has in zip(err_cols, has_flux) if has]
+    _min_rel_err = np.asarray(min_rel_err, dtype=np.float32)[has_flux]
+
+    def extract(row, aper_corr=1.):
+
+        flux = np.full(n_bands, -99., dtype=np.float32)
+        flux_err = np.full(n_bands, -99., dtype=np.float32)
+
+        # observed fluxes and their errors, for the bands with a flux column
+        conversion = aper_corr * units / Jy
+        _flux = np.array([row[name] for name in _flux_cols], dtype=np.float64).ravel() * conversion
+        _flux_err = np.array([row[name] for name in _err_cols], dtype=np.float64).ravel() * conversion
+
+        flux[has_flux] = _flux
+
+        # if defined, add the minimum error in quadrature
+        flux_err[has_flux] = np.where(_flux_err > 0.,
+                np.hypot(_flux_err, _flux*_min_rel_err),
+                _flux_err)
+
+        return flux, flux_err
+
+    return extract
+
+def get_flux_extractor(filters):
+    """ 
+    Return the (cached) flux extractor built by `_make_flux_extractor` for a
+    set of photometric filters.
+
+    Parameters
+    ----------
+    filters : class
+        Contains the photometric filters
+    """
+
+    key = (filters.flux_cols,
+            filters.err_cols,
+            filters.units,
+            tuple(filters.min_rel_err))
+
+    if key not in _flux_extractors:
+        _flux_extractors[key] = _make_flux_extractor(*key)
+
+    return _flux_extractors[key]
+
+
+def _plot_in_worker(plot, ID):
+    """ 
+    Make a plot in a worker process of `Photometry.plot_many`. The plots are
+    only saved, so the worker uses the non-interactive Agg backend (without
+    affecting the backend of the parent process), and closes its figures
+    afterwards.
+
+    Parameters
+    ----------
+    plot : `functools.partial`
+        A plotting method of `Photometry`, with its arguments.
+
+    ID : int, str
+        Contains the object ID.
+    """
+
+    if plt.get_backend().lower() != 'agg':
+        plt.switch_backend('Agg')
+
+    try:
+        plot(ID)
+    finally:
+        plot.func.__self__.close_figures()
+
+
 class PhotometricCatalogue(ObservedCatalogue):
 
     def extract_fluxes(self, filters, ID, key='ID', aper_corr=1.):
@@ -63,32 +173,12 @@ class PhotometricCatalogue(ObservedCatalogue):
 
         """
 
-        flux = np.zeros(filters.n_bands, np.float32)
-        flux_err = np.zeros(filters.n_bands, np.float32)
+        # The extractor is looked up on each call (a dictionary look-up keyed
+        # on the filter columns), so that it follows a re-loaded `filters`
+        extract = get_flux_extractor(filters)
 
-        row = extract_row(self.data, ID, key=key)
+        return extract(self.get_row(ID, key=key), aper_corr=aper_corr)
 
-        for j in range(filters.n_bands):
-
-            # observed flux and its error
-            name = filters.data['flux_colName'][j]
-            if not name:
-                flux[j] = -99.
-                flux_err[j] = -99.
-                continue
-
-            flux[j] = row[name] * aper_corr * filters.units / Jy
-
-            name = filters.data['flux_errcolName'][j]
-            flux_err[j] = row[name] * aper_corr * filters.units / Jy
-
-            if flux_err[j] > 0.:
-                # if defined, add the minimum error in quadrature
-                flux_err[j] = (np.sqrt((flux_err[j]/flux[j])**2 +
-                    np.float32(filters.data['min_rel_err'][j])**2) *
-                    abs(flux[j]))
-
-        return flux, flux_err
 
 class Photometry:
 
@@ -129,6 +219,97 @@ class Photometry:
                 self.single_solutions['ID'] = f[1].data['ID']
                 self.single_solutions['row'] = f[1].data['row_index']
 
+        # Figures (and their axes) re-used across calls to the plotting
+        # methods, kept until `close_figures` is called. They are not managed
+        # by pyplot, so they are never displayed by `plt.show()`
+        self._figures = dict()
+
+    def _get_figure(self, name, nrows=1, ncols=1, **kwargs):
+        """ 
+        Return a figure and its axes, created on the first call and then
+        cleared and re-used by the following calls with the same arguments.
+        The figure is drawn with the Agg canvas, independently of pyplot, so
+        it can only be saved.
+
+        Parameters
+        ----------
+        name : str
+            Name identifying the figure.
+
+        nrows, ncols : int, optional
+            Number of rows/columns of the grid of subplots.
+
+        **kwargs:
+            Passed to `matplotlib.figure.Figure.subplots` when creating the
+            figure.
+
+        Returns
+        -------
+        fig : `matplotlib.figure.Figure`
+
+        axs : `matplotlib.axes.Axes` or array of Axes
+        """
+
+        key = (name, nrows, ncols)
+        if key in self._figures:
+            fig, axs = self._figures[key]
+            for ax in np.ravel(axs):
+                ax.cla()
+            for text in list(fig.texts):
+                text.remove()
+            return fig, axs
+
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        axs = fig.subplots(nrows, ncols, **kwargs)
+        self._figures[key] = (fig, axs)
+
+        return fig, axs
+
+    def close_figures(self):
+        """ 
+        Release the figures re-used by the plotting methods.
+        """
+
+        self._figures.clear()
+
+    def plot_many(self, IDs, plot='plot_marginal', n_proc=1, **kwargs):
+        """ 
+        Make the same plot for a list of objects, in parallel.
+
+        Parameters
+        ----------
+        IDs : list
+            Contains the object IDs.
+
+        plot : str, optional
+            Name of the plotting method, e.g. 'plot_marginal' or
+            'plot_replicated_data'.
+
+        n_proc : int, optional
+            Number of processes used.
+
+        **kwargs:
+            Passed to the plotting method.
+        """
+
+        plot = partial(getattr(self, plot), **kwargs)
+
+        try:
+            if n_proc <= 1:
+                for ID in IDs:
+                    plot(ID)
+            else:
+                # Figures and open files are not shared with the worker
+                # processes, which open their own
+                self.close_figures()
+                close_BEAGLE_results()
+
+                pool = ProcessingPool(nodes=n_proc)
+                pool.map(partial(_plot_in_worker, plot), IDs)
+        finally:
+            self.close_figures()
+
     def plot_marginal(self, ID, max_interval=99.7, 
             print_text=False, print_title=False, replot=False, show=False, units='nanoJy',
             SED_prob_log_scale=False, n_SED_to_plot=10):
@@ -182,7 +363,7 @@ class Photometry:
 
         # From the (previously loaded) observed catalogue select the row
         # corresponding to the input ID
-        observation = extract_row(self.observed_catalogue.data, ID, key=self.key)
+        observation = self.observed_catalogue.get_row(ID, key=self.key)
 
         # Check if you need to apply an aperture correction to the catalogue fluxes
         if 'aper_corr' in self.observed_catalogue.data.dtype.names:
@@ -195,14 +376,16 @@ class Photometry:
         obs_flux *= flux_factor
         obs_flux_err *= flux_factor
 
-        fig = plt.figure()
-        ax = fig.add_subplot(1, 1, 1)
+        # When showing the plot the figure is closed at the end, otherwise it
+        # is re-used by the next call
+        if show:
+            fig = plt.figure()
+            ax = fig.add_subplot(1, 1, 1)
+        else:
+            fig, ax = self._get_figure('marginal')
 
         # Open the file containing BEAGLE results
-        fits_file = os.path.join(BeagleDirectories.results_dir,
-                str(ID) + '_' + BeagleDirectories.suffix + '.fits.gz')
-
-        hdulist = fits.open(fits_file)
+        hdulist = open_BEAGLE_results(ID)
 
         # Consider only the extension containing the predicted model fluxes
         old_API = False
@@ -212,73 +395,73 @@ class Photometry:
         except:
             model_sed = hdulist['apparent magnitudes']
 
-        probability = hdulist['posterior pdf'].data['probability']
+        # The model fluxes and probabilities are handled in single precision,
+        # which is enough for plotting and halves the memory traffic
+        probability = hdulist['posterior pdf'].data['probability'].astype(np.float32, copy=False)
 
         n_bands = len(obs_flux)
         median_flux = np.zeros(n_bands)
         pdf_norm = np.zeros(n_bands)
         _max_y = np.zeros(n_bands)
-        min_flux = np.zeros(n_bands)
-        max_flux = np.zeros(n_bands)
 
         y_plot = list(range(n_bands))
         x_plot = list(range(n_bands))
 
-        has_pdf = list(range(n_bands))
-        kde_pdf = list(range(n_bands))
+        pdf_median = np.zeros(n_bands)
         nXgrid = 1000
 
+        # Bands sorted by effective wavelength
+        sor = self.filters.sort_index
         if self.x_log:
-            wl_eff = np.log10(self.filters.data['wl_eff'])
+            wl_eff = self.filters.sorted_log_wl_eff
+            delta_wl = self.filters.log_delta_wl / 2.
         else:
-            wl_eff = np.array(self.filters.data['wl_eff'])
+            wl_eff = self.filters.sorted_wl_eff
+            delta_wl = self.filters.delta_wl / 2.
 
-        # Sort wl_eff array
-        sor = np.argsort(wl_eff)
-
-        obs_flux, obs_flux_err, wl_eff = obs_flux[sor], obs_flux_err[sor], wl_eff[sor]
+        obs_flux, obs_flux_err = obs_flux[sor], obs_flux_err[sor]
 
         ok = np.where(obs_flux_err > 0.)[0]
 
-        width = 5*np.min(wl_eff[1:]-wl_eff[0:-1])
-
         kwargs = {'color':'tomato', 'alpha':0.8, 'edgecolor':'black', 'linewidth':0.2}
 
+        # Model fluxes in each band (one row per band)
+        fluxes = np.empty((n_bands, len(probability)), dtype=np.float32)
+
         for i in range(n_bands):
 
             if old_API:
-                band_name = self.filters.data['label'][sor[i]]
-                xdata = model_sed.data['_'+band_name+'_'] / Jy * flux_factor
+                fluxes[i, :] = model_sed.data[self.filters.model_cols[sor[i]]]
+                fluxes[i, :] *= flux_factor/Jy
             else:
                 band_name = self.filters.data['name'][sor[i]] + "_APP"
-                xdata = 10.**(0.4*(8.9-model_sed.data[band_name])) * flux_factor
-
-            min_x = np.min(xdata)
-            max_x = np.max(xdata)
-
-            min_flux[i] = np.min([min_x, obs_flux[i]-obs_flux_err[i]])
-            max_flux[i] = np.max([max_x, obs_flux[i]+obs_flux_err[i]])
-
-            # if min_x == max_x, then you can not use weighted KDE, since you
-            # just have one value for the x...this usually happens bacause of
-            # IGM absorption, which absorbs the flux blue-ward 1216 AA, making
-            # all flux = 0
-            if min_x == max_x:
-                has_pdf[i] = False
-                median_flux[i] = min_x
-                continue
-
-            # Compute the marginal PDF through a weighted KDE
-            has_pdf[i] = True
-
-            # This function provides you with all the necessary info to draw violin plots
-            kde_pdf[i], pdf_norm[i], median_flux[i], x_plot[i], y_plot[i] = prepare_violin_plot(xdata, weights=probability) 
-
-            _max_y[i] = np.max(y_plot[i])
-
-        delta_wl = wl_eff[1:]-wl_eff[0:-1]
-        delta_wl = np.concatenate(([delta_wl[0]], delta_wl))
-        delta_wl /=  2.
+                fluxes[i, :] = 10.**(0.4*(8.9-model_sed.data[band_name].astype(np.float32, copy=False))) * flux_factor
+
+        min_x = np.min(fluxes, axis=1)
+        max_x = np.max(fluxes, axis=1)
+
+        min_flux = np.minimum(min_x, obs_flux-obs_flux_err)
+        max_flux = np.maximum(max_x, obs_flux+obs_flux_err)
+
+        # if min_x == max_x, then you can not use weighted KDE, since you
+        # just have one value for the x...this usually happens bacause of
+        # IGM absorption, which absorbs the flux blue-ward 1216 AA, making
+        # all flux = 0
+        has_pdf = min_x != max_x
+        median_flux[~has_pdf] = min_x[~has_pdf]
+
+        # Compute the marginal PDFs through weighted KDEs, all at once. This
+        # function provides you with all the necessary info to draw violin plots
+        with_pdf = np.where(has_pdf)[0]
+        if len(with_pdf) > 0:
+            _, _pdf_norm, _median, _x_plot, _y_plot, _pdf_median = \
+                    prepare_violin_plot_batch(fluxes[with_pdf, :], weights=probability,
+                            return_pdf_median=True)
+
+            for k, i in enumerate(with_pdf):
+                pdf_median[i], pdf_norm[i], median_flux[i] = _pdf_median[k], _pdf_norm[k], _median[k]
+                x_plot[i], y_plot[i] = _x_plot[k], _y_plot[k]
+                _max_y[i] = np.max(y_plot[i])
 
         for i in range(n_bands):
 
@@ -290,12 +473,11 @@ class Photometry:
 
                 w = 0.4 * dwl / _max_y[i]
 
-                y_grid = np.full(len(x_plot[i]), wl_eff[i])
-                _lim_y = kde_pdf[i](median_flux[i])/pdf_norm[i] * w
+                _lim_y = pdf_median[i] * w
 
                 ax.fill_betweenx(x_plot[i],
-                        y_grid - y_plot[i]*w,
-                        y_grid + y_plot[i]*w,
+                        wl_eff[i] - y_plot[i]*w,
+                        wl_eff[i] + y_plot[i]*w,
                         **kwargs
                         )
 
@@ -391,7 +573,9 @@ class Photometry:
 
         # Determine min and max values of y-axis
         yMax = np.max(max_flux)
-        yMin = np.min(np.concatenate((obs_flux[ok], min_flux)))
+        yMin = np.min(min_flux)
+        if len(ok) > 0:
+            yMin = min(yMin, np.min(obs_flux[ok]))
 
         dY = yMax-yMin
 
@@ -409,7 +593,7 @@ class Photometry:
         ax.set_xlim([x0-0.05*dx, x1+0.05*dx])
 
         x0, x1 = ax.get_xlim()
-        if yMin < 0.: plt.plot( [x0,x1], [0.,0.], color='gray', lw=0.8 )
+        if yMin < 0.: ax.plot( [x0,x1], [0.,0.], color='gray', lw=0.8 )
 
         # Plot labels of photometric filters
         if self.plot_filter_labels:
@@ -459,7 +643,7 @@ class Photometry:
 
         kwargs = {'alpha':0.7}
 
-        plt.errorbar(wl_eff[ok], 
+        ax.errorbar(wl_eff[ok], 
                 obs_flux[ok], 
                 yerr = obs_flux_err[ok],
                 color = "dodgerblue",
@@ -474,8 +658,8 @@ class Photometry:
         if self.single_solutions is not None:
             row =  self.single_solutions['row'][self.single_solutions['ID']==ID]
             solution = np.zeros(n_bands, dtype=np.float32)
-            for i, band_name in enumerate((self.filters.data['label'][sor])):
-                solution[i] = model_sed.data['_'+band_name+'_'][row] / nanoJy
+            for i, j in enumerate(sor):
+                solution[i] = model_sed.data[self.filters.model_cols[j]][row] / nanoJy
 
             ax.plot(wl_eff,
                     solution,
@@ -491,7 +675,7 @@ class Photometry:
             which = 'x'
 
         # Title of the plot is the object ID
-        if print_title: plt.title(str(ID))
+        if print_title: ax.set_title(str(ID))
 
         # Location of printed text
         x0, x1 = ax.get_xlim()
@@ -509,7 +693,7 @@ class Photometry:
 
             # Print the average reduced chi-square
             try:
-                row = extract_row(self.PPC.data, ID, key=self.key)
+                row = self.PPC.get_row(ID, key=self.key)
                 aver_chi_square = row['aver_chi_square']
                 y = y1 - (y1-y0)*0.15
                 ax.text(x, y, "$\langle\chi^2\\rangle=" + "{:.2f}".format(aver_chi_square) + "$", fontsize=10 )
@@ -518,7 +702,7 @@ class Photometry:
                 "<chi^2> for the object `" + str(ID) + "` is not available"
 
             try:
-                row = extract_row(self.PPC.data, ID, key=self.key)
+                row = self.PPC.get_row(ID, key=self.key)
                 aver_red_chi_square = row['aver_red_chi_square']
                 n_data = row['n_used_bands']
                 y = y1 - (y1-y0)*0.20
@@ -531,10 +715,11 @@ class Photometry:
                 print "`PosteriorPredictiveChecks` not computed/loaded, hence " \
                 "<chi^2_red> for the object `" + str(ID) + "` is not available"
 
-        if y0 < 0.: plt.plot( [x0,x1], [0.,0.], color='gray', lw=1.0 )
+        if y0 < 0.: ax.plot( [x0,x1], [0.,0.], color='gray', lw=1.0 )
 
         if show:
             plt.show()
+            plt.close(fig)
         else:
             name = prepare_plot_saving(plot_name)
 
@@ -542,10 +727,6 @@ class Photometry:
                     orientation='portrait', papertype='a4', format="pdf",
                     transparent=False, bbox_inches="tight", pad_inches=0.1)
 
-        plt.close(fig)
-
-        hdulist.close()
-
     def plot_replicated_data(self, ID, max_interval=99.7, n_replic_to_plot=16,
             print_text=False, replot=False):    
         """ 
@@ -604,7 +785,7 @@ class Photometry:
 
         # From the (previously loaded) observed catalogue select the row
         # corresponding to the input ID
-        observation = extract_row(self.observed_catalogue.data, ID, key=self.key)
+        observation = self.observed_catalogue.get_row(ID, key=self.key)
 
         # Check if you need to apply an aperture correction to the catalogue fluxes
         if 'aper_corr' in self.observed_catalogue.data.dtype.names:
@@ -615,11 +796,12 @@ class Photometry:
         # Put observed photometry and its error in arrays
         obs_flux, obs_flux_err = self.observed_catalogue.extract_fluxes(self.filters, ID, key=self.key)
 
-        # Sort wl_eff array
-        wl_eff = np.array(self.filters.data['wl_eff'])
-        sor = np.argsort(wl_eff)
+        # Bands sorted by effective wavelength
+        sor = self.filters.sort_index
+        wl_eff = self.filters.sorted_wl_eff
+        delta_wl = self.filters.delta_wl
 
-        obs_flux, obs_flux_err, wl_eff = obs_flux[sor], obs_flux_err[sor], wl_eff[sor]
+        obs_flux, obs_flux_err = obs_flux[sor], obs_flux_err[sor]
 
         obs_flux *= flux_factor
         obs_flux_err *= flux_factor
@@ -628,10 +810,7 @@ class Photometry:
         ok = np.where(obs_flux_err > 0.)[0]
 
         # Open the file containing BEAGLE results
-        fits_file = os.path.join(BeagleDirectories.results_dir,
-                str(ID)+'_BEAGLE.fits.gz')
-
-        model_hdu = fits.open(fits_file)
+        model_hdu = open_BEAGLE_results(ID)
         model_sed = model_hdu['marginal photometry']
 
         # Open the file containing the replicated data
@@ -639,7 +818,7 @@ class Photometry:
                 BeagleDirectories.pypbeagle_data,
                 str(ID)+'_BEAGLE_replic_data.fits.gz')
 
-        replic_hdu = fits.open(fits_file)
+        replic_hdu = open_FITS_file(fits_file)
         replic_data = replic_hdu[1]
 
         n_replicated = replic_data.data.field(0).size
@@ -648,37 +827,37 @@ class Photometry:
         n_bands = len(replic_data.columns.names)-1
 
         indices = replic_data.data['row_index']
-        noiseless_flux = np.zeros((n_bands, indices.size))
 
-        for i, band_name in enumerate((self.filters.data['label'][sor])):
-            noiseless_flux[i, :] = model_sed.data['_'+band_name+'_'] / Jy * flux_factor
+        # Names of the columns containing the fluxes in each band, sorted by
+        # wavelength
+        band_cols = [self.filters.model_cols[i] for i in sor]
+
+        # Noise-less fluxes predicted by the model for the rows used to
+        # create the replicated data, and replicated fluxes (in single
+        # precision, as the observed ones)
+        noiseless_flux = np.array([model_sed.data[name][indices] for name in band_cols], dtype=np.float32)
+        noiseless_flux *= flux_factor/Jy
+        replic_fluxes = np.array([replic_data.data[name] for name in band_cols], dtype=np.float32)
+        replic_fluxes *= flux_factor
+
+        # Compute the p-value band-by-band, for the bands with measurements
+        # (the observed fluxes and errors are broadcast along the replicated
+        # data axis)
+        inv_var = 1. / obs_flux_err[ok, np.newaxis]**2
+        obs_discr = (obs_flux[ok, np.newaxis] - noiseless_flux[ok, :])**2 * inv_var
+        repl_discr = (replic_fluxes[ok, :] - noiseless_flux[ok, :])**2 * inv_var
 
-        # Compute the p-value band-by-band
         p_value_bands = np.zeros(n_bands)
-        replic_fluxes = np.zeros((n_bands, n_replicated))
-        for i, band_name in enumerate((self.filters.data['label'][sor])):
-            
-            if obs_flux_err[i] > 0.:
-                obs_discr = (obs_flux[i].repeat(n_replicated)-noiseless_flux[i, :])**2 / obs_flux_err[i].repeat(n_replicated)**2
-                repl_discr = (replic_data.data['_'+band_name+'_']*flux_factor - noiseless_flux[i, :])**2 / obs_flux_err[i].repeat(n_replicated)**2
-
-                replic_fluxes[i,:] = replic_data.data['_'+band_name+'_'] * flux_factor
-                p_value_bands[i] = 1. * np.count_nonzero((repl_discr >
-                    obs_discr)) / n_replicated
+        p_value_bands[ok] = np.mean(repl_discr > obs_discr, axis=1)
 
         markers = np.array("o").repeat(n_bands)
         loc = np.where(p_value_bands <= p_value_lim)[0]
         markers[loc] = "o"
         print "p_value_bands: ", p_value_bands
 
-        ext_obs_flux = obs_flux.reshape(n_bands, 1).repeat(n_replicated, 1)
-        ext_obs_flux_err = obs_flux_err.reshape(n_bands, 1).repeat(n_replicated, 1)
-
-        obs_discr = np.sum((ext_obs_flux[ok,:]-noiseless_flux[ok,:])**2 / ext_obs_flux_err[ok,:]**2, axis=0)
-        repl_discr = np.sum((replic_fluxes[ok,:]-noiseless_flux[ok,:])**2 / ext_obs_flux_err[ok,:]**2, axis=0)
-
-        p_value = 1. * np.count_nonzero((repl_discr >
-            obs_discr)) / n_replicated
+        # The global discrepancy is the sum of the band-by-band ones
+        p_value = 1. * np.count_nonzero((np.sum(repl_discr, axis=0) >
+            np.sum(obs_discr, axis=0))) / n_replicated
         
         print "p_value: ", p_value
 
@@ -687,73 +866,31 @@ class Photometry:
         _max_y = np.zeros(n_bands)
         max_abs_flux = np.zeros(n_plot_x*n_plot_y)
 
-        # Compute mean residual
-        replic_fluxes = np.zeros((n_bands, n_replicated))
-        mean_replic_fluxes = np.zeros(n_bands)
-        for i, band_name in enumerate((self.filters.data['label'][sor])):
-            mean_replic_fluxes[i] = np.mean(replic_data.data['_'+band_name+'_']) * flux_factor
-            replic_fluxes[i,:] = replic_data.data['_'+band_name+'_'] * flux_factor
-
-        mean_residual = (mean_replic_fluxes-obs_flux)/obs_flux_err 
-
-        # Compute variance-covariance matrix of residual
-        residual_fluxes = (replic_fluxes-obs_flux.reshape(n_bands,
-            1).repeat(n_replicated, 1)) / obs_flux_err.reshape(n_bands,
-                    1).repeat(n_replicated, 1)
-
-        residual_covar = np.cov(residual_fluxes)
-        print "residual_covar: ", residual_covar
-
-        # Plot the variance-covariance matrix of residuals
-        if 'sns' in sys.modules:
-
-            sns.set(style="white")
-            labels = list()
-            for lab in self.filters.data['label']:
-                labels.append(lab.split('_')[-1])
-                
-            #d = pd.DataFrame(data=np.abs(residual_fluxes.T),
-            #        columns=labels)
-
-            # Compute the correlation matrix
-            #corr = d.corr()
-
-            # Generate a mask for the upper triangle
-            mask = np.zeros_like(corr, dtype=np.bool)
-            mask[np.triu_indices_from(mask)] = True
-
-            # Set up the matplotlib figure
-            fig, ax = plt.subplots()
-
-            # Generate a custom diverging colormap
-            cmap = sns.diverging_palette(220, 10, as_cmap=True)
-
-            # Draw the heatmap with the mask and correct aspect ratio
-            sns.heatmap(corr, mask=mask, cmap=cmap, vmax=0.4,
-                    square=True, annot=True, fmt=".2f", annot_kws={"size": 10},
-                    linewidths=.5, cbar_kws={"shrink": .85}, ax=ax)
-
-            # Rotate by 45 deg the x and y ticks so they do not overlap
-            plt.setp( ax.xaxis.get_majorticklabels(), rotation=45,
-                    horizontalalignment='right' )
-
-            plt.setp( ax.yaxis.get_majorticklabels(), rotation=45,
-                    horizontalalignment='right' )
-
-            name = prepare_plot_saving(str(ID)+'_BEAGLE_replic_data_phot_matrix.pdf')
-
-            fig.savefig(name, dpi=None, facecolor='w', edgecolor='w',
-                    orientation='portrait', papertype='a4', format="pdf",
-                    transparent=False, bbox_inches="tight", pad_inches=0.1)
-
-            fig.clear()
-            plt.close(fig)
+        # Normalized residuals of the replicated data (the i-th row
+        # corresponds to the band ok[i]), computed in place on the copy
+        # returned by the fancy indexing
+        inv_err = 1. / obs_flux_err[ok, np.newaxis]
+        residual_fluxes = replic_fluxes[ok, :]
+        residual_fluxes -= obs_flux[ok, np.newaxis]
+        residual_fluxes *= inv_err
+
+        # Compute mean residual (left to zero for the bands without
+        # measurements)
+        mean_residual = np.zeros(n_bands)
+        mean_residual[ok] = np.mean(residual_fluxes, axis=1)
+
+        # The variance-covariance matrix of the residuals is only reported
+        # when running verbose
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            residual_covar = np.cov(residual_fluxes)
+            logging.info("residual_covar: " + str(residual_covar))
 
         # Select a random set of repliated data
         np.random.seed(seed=12345678)
         replic_data_rows = np.random.choice(n_replicated, size=n_plot_x*n_plot_y)    
 
-        fig, axs = plt.subplots(n_plot_x, n_plot_y, sharex=True, sharey=True)
+        fig, axs = self._get_figure('replicated_data', n_plot_x, n_plot_y,
+                sharex=True, sharey=True)
         fig.subplots_adjust(left=0.08, bottom=0.08, hspace=0, wspace=0)
         fontsize = 8
         axes_linewidth = 0.7
@@ -780,10 +917,7 @@ class Photometry:
 #                cap.set_color('orangered')
 #                cap.set_markeredgewidth(1)
 #
-            temp_data = replic_data.data[replic_data_rows[i]]
-            replic_fluxes = np.array(temp_data[1:]) * flux_factor
-
-            diff_fluxes = (replic_fluxes-obs_flux) / obs_flux_err
+            diff_fluxes = (replic_fluxes[:, replic_data_rows[i]]-obs_flux) / obs_flux_err
 
             kwargs = {'alpha':0.4}
             unique_markers = np.unique(markers)
@@ -811,25 +945,22 @@ class Photometry:
                 nXgrid = 1000
                 kwargs = {'alpha':0.7}
 
-                delta_wl = wl_eff[1:]-wl_eff[0:-1]
-                delta_wl = np.concatenate(([delta_wl[0]], delta_wl))
+                # No violin plots for the bands without measurements
+                for k, j in enumerate(ok):
 
-                for j in range(n_bands):
-
-                    residual = residual_fluxes[j,:]
+                    residual = residual_fluxes[k,:]
 
                     # This function provides you with all the necessary info to draw violin plots
-                    kde_pdf, pdf_norm, median_flux, x_plot, y_plot = prepare_violin_plot(residual)
+                    kde_pdf, pdf_norm, median_flux, x_plot, y_plot, pdf_median = \
+                            prepare_violin_plot(residual, return_pdf_median=True)
 
                     w = 0.4 * delta_wl[j] / np.max(y_plot)
 
-                    y_grid = np.full(len(x_plot), wl_eff[j])
-
-                    _lim_y = kde_pdf(median_flux)/pdf_norm * w
+                    _lim_y = pdf_median * w
 
                     ax.fill_betweenx(x_plot,
-                            y_grid - y_plot*w,
-                            y_grid + y_plot*w,
+                            wl_eff[j] - y_plot*w,
+                            wl_eff[j] + y_plot*w,
                             **kwargs
                             )
 
@@ -907,7 +1038,7 @@ class Photometry:
 
             # Print the average reduced chi-square
             try:
-                row = extract_row(self.PPC.data, ID, key=self.key)
+                row = self.PPC.get_row(ID, key=self.key)
                 aver_chi_square = row['aver_chi_square']
                 y = y1 - (y1-y0)*0.15
                 ax.text(x, y, "$\langle\chi^2\\rangle=" + "{:.2f}".format(aver_chi_square) + "$", fontsize=10 )
@@ -916,7 +1047,7 @@ class Photometry:
                 "<chi^2> for the object `" + str(ID) + "` is not available"
 
             try:
-                row = extract_row(self.PPC.data, ID, key=self.key)
+                row = self.PPC.get_row(ID, key=self.key)
                 aver_red_chi_square = row['aver_red_chi_square']
                 n_data = row['n_used_bands']
                 y = y1 - (y1-y0)*0.20
@@ -938,9 +1069,6 @@ class Photometry:
                 orientation='portrait', papertype='a4', format="pdf",
                 transparent=False, bbox_inches="tight", pad_inches=0.1)
 
-        plt.close(fig)
-
-        model_hdu.close()
         replic_hdu.close()
 
 ##    def plot_residuals(self, residual_file_name=None, residual_plotname=None):
@@ -10,12 +10,12 @@ import dependencies.WeightedKDE as WeightedKDE
 from dependencies.walker_random_sampling import WalkerRandomSampling
 
 from beagle_utils import prepare_data_saving, prepare_plot_saving, \
-    BeagleDirectories, set_plot_ticks
+    BeagleDirectories, set_plot_ticks, RowIndexedTable
 
 # 1 jy = 10^-23 erg s^-1 cm^-2 hz^-1
 jy = 1.E-23 
 
-class PosteriorPredictiveChecks(object):
+class PosteriorPredictiveChecks(RowIndexedTable):
 
     def chi_square(self, y, E_y, sig_y):
         """ 
@@ -70,6 +70,8 @@ class PosteriorPredictiveChecks(object):
     
         self.data = my_table
 
+        self.reset_row_index()
+
     def compute_replicated(self, observed_catalogue, filters, ID,
             n_replicated=2000, seed=1234):
 
@@ -93,8 +95,7 @@ class PosteriorPredictiveChecks(object):
 
                 model_flux = np.zeros((filters.n_bands, n_samples), np.float32)
 
-                for j in range(filters.n_bands):
-                    name = '_' + filters.data['label'][j] + '_'
+                for j, name in enumerate(filters.model_cols):
                     model_flux[j,:] = beagle_data[name] / jy
 
                 # Close the BEAGLE output file and open the file containing replicated data
@@ -145,10 +146,9 @@ class PosteriorPredictiveChecks(object):
                 obs_flux, obs_flux_err = observed_catalogue.extract_fluxes(filters, ID)
                 n_data = np.count_nonzero(obs_flux_err > 0.)
 
-                for j in range(filters.n_bands):
+                for j, name in enumerate(filters.model_cols):
 
                     # model flux
-                    name = '_' + filters.data['label'][j] + '_'
                     model_flux[j,:] = beagle_data[name] / jy
 
                 # You save in this array the noise-less flux predicted by the model        
@@ -328,6 +328,7 @@ class PosteriorPredictiveChecks(object):
 
         self.columns = my_cols
         self.data = my_table
+        self.reset_row_index()
 
         name = prepare_data_saving(file_name)
         my_table.write(name)
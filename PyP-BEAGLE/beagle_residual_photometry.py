@@ -79,10 +79,10 @@ class ResidualPhotometry(object):
 
         for i in range(filters.n_bands):
 
-            obs_flux = catalogue_data[filters.data['flux_colName'][i]] * filters.units / jy
-            obs_flux_err = catalogue_data[filters.data['flux_errcolName'][i]] * filters.units  / jy
+            obs_flux = catalogue_data[filters.flux_cols[i]] * filters.units / jy
+            obs_flux_err = catalogue_data[filters.err_cols[i]] * filters.units  / jy
 
-            name = '_' + filters.data['label'][i] + '_'
+            name = filters.model_cols[i]
             model_flux = beagle_data[name+'_'+summary_stat] / jy
             model_flux_err = 0.5 * (beagle_data[name+'_68.00'][:,1]-beagle_data[name+'_68.00'][:,0]) / jy
 
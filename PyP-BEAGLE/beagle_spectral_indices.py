@@ -28,7 +28,7 @@ from dependencies import FillBetweenStep
 from significant_digits import to_precision
 
 from beagle_utils import BeagleDirectories, prepare_plot_saving, set_plot_ticks, plot_exists, \
-        prepare_violin_plot, extract_row
+        prepare_violin_plot
 
 from beagle_observed_catalogue import ObservedCatalogue
 
@@ -115,7 +115,7 @@ class SpectralIndices(object):
 
         # From the (previously loaded) observed catalogue select the row
         # corresponding to the input ID
-        observation = extract_row(self.observed_catalogue.data, ID, key=self.key)
+        observation = self.observed_catalogue.get_row(ID, key=self.key)
 
         fig = plt.figure(figsize=(12, 3))
         ax = fig.add_subplot(1, 1, 1)
@@ -159,14 +159,14 @@ class SpectralIndices(object):
 
             # This function provides you with all the necessary info to draw violin plots
             _model_flux = model_fluxes[key]
-            kde_pdf, pdf_norm, median_flux, x_plot, y_plot = prepare_violin_plot(_model_flux, weights=probability) 
+            kde_pdf, pdf_norm, median_flux, x_plot, y_plot, pdf_median = \
+                    prepare_violin_plot(_model_flux, weights=probability, return_pdf_median=True)
             _model_fluxes[i] = median_flux
 
             _max_y = np.max(y_plot)
             w = width / _max_y
 
-            y_grid = np.full(len(x_plot), X)
-            _lim_y = kde_pdf(median_flux)/pdf_norm * w
+            _lim_y = pdf_median * w
 
             kwargs = {'alpha':0.8}
             ax.errorbar(X,
@@ -190,8 +190,8 @@ class SpectralIndices(object):
 
             kwargs = {'color':'tomato', 'alpha':0.7, 'edgecolor':'black', 'linewidth':0.2}
             ax.fill_betweenx(x_plot,
-                    y_grid - y_plot*w,
-                    y_grid + y_plot*w,
+                    X - y_plot*w,
+                    X + y_plot*w,
                     zorder=2,
                     **kwargs
                     )
@@ -1,19 +1,32 @@
 import fnmatch
 import re
+import math
 import os
+import errno
+import time
 import logging
+import gzip
+import shutil
+import hashlib
 import numpy as np
 from bisect import bisect_left
+from collections import OrderedDict
 from scipy.integrate import simps, cumtrapz
 from scipy.interpolate import interp1d
-from datetime import datetime
 
 import sys
-import dependencies.WeightedKDE as WeightedKDE
 
 import matplotlib.ticker as plticker
 import matplotlib as mpl
 
+from astropy.io import fits
+
+# Numba is optional: when available the ID matching kernel is JIT-compiled
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 
 ID_COLUMN_LENGTH = 100
 
@@ -78,6 +91,125 @@ def extract_row(table, ID, key=None):
 
     return row
 
+def build_row_index(table, key=None):
+    """ 
+    Map the values of a column (by default the object IDs) to the rows of a table.
+
+    Parameters
+    ----------
+    table : Table, FITS_rec or structured array
+        The table.
+
+    key : str, optional
+        Name of the column (by default 'ID').
+
+    Returns
+    -------
+    dict
+        The row index corresponding to each value of the column. The values
+        are converted to str or int, as done in `extract_row`, and if a value
+        appears more than once the first row is used.
+    """
+
+    if key is None:
+        key='ID'
+
+    column = table[key]
+
+    if len(column) > 0 and isinstance(column[0], basestring):
+        values = [str(value) for value in column]
+    else:
+        values = [int(value) for value in column]
+
+    row_index = dict()
+    for i, value in enumerate(values):
+        row_index.setdefault(value, i)
+
+    return row_index
+
+def extract_indexed_row(table, row_index, ID):
+    """ 
+    Extract the row corresponding to an ID, using an index built with `build_row_index`.
+
+    Parameters
+    ----------
+    table : Table, FITS_rec or structured array
+        The table.
+
+    row_index : dict
+        The index returned by `build_row_index` for `table`.
+
+    ID : int, str
+        The object ID.
+
+    Returns
+    -------
+    row : 
+        A one-row slice of `table`, as returned by `extract_row`.
+    """
+
+    if len(row_index) > 0 and isinstance(next(iter(row_index)), basestring):
+        ID = str(ID)
+    else:
+        ID = int(ID)
+
+    try:
+        i = row_index[ID]
+    except KeyError:
+        raise ValueError("Cannot extract the row corresponding to the keyvalue '"+str(ID)+"'")
+
+    return table[i:i+1]
+
+class RowIndexedTable(object):
+    """ 
+    Mixin for classes holding a table in `self.data`, providing the look-up
+    of the table rows by object ID through cached row indices.
+
+    Classes using it must call `reset_row_index` whenever `self.data` changes.
+    """ 
+
+    def reset_row_index(self):
+        """ 
+        Discard the row indices built for the current table.
+        """ 
+
+        self._row_index = dict()
+
+    def get_row(self, ID, key=None):
+        """ 
+        Extract the row corresponding to a given object.
+
+        Parameters
+        ----------
+        ID : int, str
+            Contains the object ID.
+
+        key : str, optional
+            Name of the column containing the IDs (by default 'ID').
+
+        Returns
+        -------
+        row : 
+            A one-row slice of the table, as returned by `extract_row`.
+
+        Notes
+        -----
+        The first call for a given `key` builds a dictionary mapping the IDs
+        to the table rows, so that subsequent calls do not need to scan the
+        whole table.
+        """
+
+        if key is None:
+            key = 'ID'
+
+        if not hasattr(self, '_row_index'):
+            self.reset_row_index()
+
+        if key not in self._row_index:
+            self._row_index[key] = build_row_index(self.data, key=key)
+
+        return extract_indexed_row(self.data, self._row_index[key], ID)
+
 def pause():
 
     try:
@@ -169,6 +301,11 @@ class BeagleDirectories(object):
     fontsize = 16
     inset_fontsize_fraction = 0.7
 
+    # Directory where decompressed copies of gzipped FITS files are kept (see
+    # `open_FITS_file`), by default taken from the $BEAGLE_FITS_CACHE
+    # environment variable. If None, the gzipped files are read directly.
+    fits_cache_dir = os.environ.get('BEAGLE_FITS_CACHE')
+
 def get_files_list(results_dir=None, suffix=None):
     """ 
     Get all files ending with suffix.
@@ -244,15 +381,191 @@ def find_file(file_name, path):
 
     return None
 
-def prepare_data_saving(file_name, results_dir=None, overwrite=False):
+def decompressed_FITS_file(file_name, cache_dir=None):
+    """ 
+    Return the name of a decompressed copy of a gzipped FITS file, creating
+    (or refreshing) the copy if it does not exist (or is older than the
+    gzipped file).
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the gzipped FITS file.
+
+    cache_dir : str, optional
+        Directory containing the decompressed copies. By default uses
+        ``BeagleDirectories.fits_cache_dir``.
+
+    Returns
+    -------
+    file_name : str
+        Name of the decompressed copy, or the input file name if the file
+        is not gzipped or no cache directory is defined.
+    """ 
+
+    if cache_dir is None:
+        cache_dir = BeagleDirectories.fits_cache_dir
+
+    if not cache_dir or not file_name.endswith('.gz'):
+        return file_name
+
+    # The copies of files from different directories are kept in different
+    # sub-directories, so that files with the same name do not clash
+    abs_name = os.path.abspath(file_name)
+    directory = os.path.join(os.path.expandvars(cache_dir),
+            hashlib.md5(os.path.dirname(abs_name)).hexdigest())
+    _ensure_directory(directory)
+
+    cached_name = os.path.join(directory, os.path.basename(abs_name)[:-len('.gz')])
+
+    if not os.path.isfile(cached_name) or \
+            os.path.getmtime(cached_name) < os.path.getmtime(abs_name):
+        # Decompress into a temporary file, then rename it, so that other
+        # processes never see a partially written copy
+        tmp_name = cached_name + '.' + str(os.getpid()) + '.tmp'
+        with gzip.open(abs_name, 'rb') as f_in, open(tmp_name, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.rename(tmp_name, cached_name)
+
+    return cached_name
+
+
+def open_FITS_file(file_name, **kwargs):
+    """ 
+    Open a FITS file, memory-mapped, reading gzipped files from their
+    decompressed copy (see `decompressed_FITS_file`) when possible.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the FITS file.
+
+    **kwargs:
+        Passed to `astropy.io.fits.open`.
+
+    Returns
+    -------
+    hdulist : `astropy.io.fits.HDUList`
     """ 
-    Prepare directory to save a data file.  
+
+    kwargs.setdefault('memmap', True)
+
+    return fits.open(decompressed_FITS_file(file_name), **kwargs)
+
+
+# Maximum number of BEAGLE results files kept open by `open_BEAGLE_results`
+MAX_OPEN_RESULTS = 32
+
+# Open BEAGLE results files, keyed by file name, in least recently used order
+_open_results = OrderedDict()
+
+def open_BEAGLE_results(ID, results_dir=None, suffix=None):
+    """ 
+    Open the BEAGLE results file of a given object.
+
+    Parameters
+    ----------
+    ID : int, str
+        Contains the object ID.
+
+    results_dir : str, optional
+        Directory containing the BEAGLE results files. By default uses
+        ``BeagleDirectories.results_dir``.
+
+    suffix: str, optional
+       Suffix of the BEAGLE results files. By default ``BeagleDirectories.suffix``
+
+    Returns
+    -------
+    hdulist : `astropy.io.fits.HDUList`
+        The (memory-mapped when possible) content of the results file. The
+        file is kept open and shared among callers, so it must not be
+        closed by them.
+
+    Notes
+    -----
+    The last ``MAX_OPEN_RESULTS`` files are kept open, and re-opened only
+    if modified on disk.
+    """ 
+
+    if results_dir is None:
+        results_dir = BeagleDirectories.results_dir
+
+    if suffix is None:
+        suffix = BeagleDirectories.suffix
+
+    file_name = os.path.join(results_dir, str(ID) + '_' + suffix + '.fits.gz')
+    mtime = os.path.getmtime(file_name)
+
+    if file_name in _open_results:
+        _mtime, hdulist = _open_results.pop(file_name)
+        if _mtime == mtime:
+            _open_results[file_name] = (mtime, hdulist)
+            return hdulist
+        hdulist.close()
+
+    hdulist = open_FITS_file(file_name)
+    _open_results[file_name] = (mtime, hdulist)
+
+    # Close the least recently used files
+    while len(_open_results) > MAX_OPEN_RESULTS:
+        _mtime, _hdulist = _open_results.popitem(last=False)[1]
+        _hdulist.close()
+
+    return hdulist
+
+def close_BEAGLE_results():
+    """ 
+    Close all the BEAGLE results files kept open by `open_BEAGLE_results`.
+    """ 
+
+    for mtime, hdulist in _open_results.values():
+        hdulist.close()
+
+    _open_results.clear()
+
+# Directories already created (or found) by `_ensure_directory`
+_ensured_dirs = set()
+
+def _ensure_directory(directory):
+    """ 
+    Create a directory, if it does not exist yet.
+
+    Parameters
+    ----------
+    directory : str
+        Path of the directory.
+
+    Notes
+    -----
+    The directories already checked are remembered, so that saving many files
+    in the same directory only hits the file system once.
+    """ 
+
+    if directory in _ensured_dirs:
+        return
+
+    try:
+        os.makedirs(directory)
+        logging.info("Creating the directory: " + directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(directory):
+            raise
+
+    _ensured_dirs.add(directory)
+
+def _prepare_saving(file_name, sub_dir, results_dir=None, overwrite=False):
+    """ 
+    Prepare directory to save a file in a sub-directory of the PyP-BEAGLE tree.
 
     Parameters
     ----------
     file_name : str
         Name of the output file (without directory tree).
 
+    sub_dir : str
+        Sub-directory (relative to `results_dir`) where the file will be saved.
+
     results_dir : str, optional
         Directory containing the BEAGLE output files. By default uses the
         RESULTS_DIR constant.
@@ -270,19 +583,50 @@ def prepare_data_saving(file_name, results_dir=None, overwrite=False):
     if results_dir is None:
         results_dir = BeagleDirectories.results_dir
 
-    directory = os.path.join(results_dir, BeagleDirectories.pypbeagle_data)
-    if not os.path.exists(directory):
-        logging.info("Creating the directory: " + directory)
-        os.makedirs(directory)
+    directory = os.path.join(results_dir, sub_dir)
+    _ensure_directory(directory)
 
     name = os.path.join(directory, os.path.basename(file_name))
-    if os.path.isfile(name) and not overwrite:
-        new_name = os.path.splitext(name)[0] + datetime.now().strftime("-%Y%m%d-%H%M%S") + os.path.splitext(name)[1]
-        logging.warning("The file " + name + " already exists, and it will be renamed to " + new_name)
-        os.rename(name, new_name)
+    if not overwrite:
+        new_name = os.path.splitext(name)[0] + time.strftime("-%Y%m%d-%H%M%S") + os.path.splitext(name)[1]
+        # Just try the renaming, rather than checking beforehand whether the
+        # file exists (it usually does not)
+        try:
+            os.rename(name, new_name)
+            logging.warning("The file " + name + " already existed, and it has been renamed to " + new_name)
+        except OSError as e:
+            # The file does not exist, so there is nothing to rename
+            if e.errno != errno.ENOENT:
+                raise
 
     return name
 
+def prepare_data_saving(file_name, results_dir=None, overwrite=False):
+    """ 
+    Prepare directory to save a data file.  
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the output file (without directory tree).
+
+    results_dir : str, optional
+        Directory containing the BEAGLE output files. By default uses the
+        RESULTS_DIR constant.
+
+    overwrite: bool, optional
+        If rue overwrites the file, is already present, while False makes a copy of
+        the original file to avoid overwriting
+
+    Returns
+    -------
+    name : str
+        Full path to the output file,
+    """ 
+
+    return _prepare_saving(file_name, BeagleDirectories.pypbeagle_data,
+            results_dir=results_dir, overwrite=overwrite)
+
 def getPathForPlot(file_name, results_dir=None):
     """ 
     """ 
@@ -368,21 +712,8 @@ def prepare_plot_saving(file_name, results_dir=None, overwrite=False):
         Full path to the output file,
     """ 
 
-    if results_dir is None:
-        results_dir = BeagleDirectories.results_dir
-
-    directory = os.path.join(results_dir, BeagleDirectories.pypbeagle_plot)
-    if not os.path.exists(directory):
-        logging.info("Creating the directory: " + directory)
-        os.makedirs(directory)
-
-    name = os.path.join(directory, os.path.basename(file_name))
-    if os.path.isfile(name) and not overwrite:
-        new_name = os.path.splitext(name)[0] + datetime.now().strftime("-%Y%m%d-%H%M%S") + os.path.splitext(name)[1]
-        logging.warning("The file " + name + " already exists, and it will be renamed to " + new_name)
-        os.rename(name, new_name)
-
-    return name
+    return _prepare_saving(file_name, BeagleDirectories.pypbeagle_plot,
+            results_dir=results_dir, overwrite=overwrite)
 
 def set_font_size(ax, fontsize):
 
@@ -391,7 +722,8 @@ def set_font_size(ax, fontsize):
         item.set_fontsize(fontsize)
 
 
-def set_plot_ticks(ax, which='both', n_x=4, n_y=4, prune_x=None, prune_y=None):
+def set_plot_ticks(ax, which='both', n_x=4, n_y=4, prune_x=None, prune_y=None,
+        minor_x=True, minor_y=True):
     """ 
     Set the major and minor ticks of plots.
 
@@ -413,21 +745,93 @@ def set_plot_ticks(ax, which='both', n_x=4, n_y=4, prune_x=None, prune_y=None):
     prune_y : str, optional 
         Either 'lower' | 'upper' | 'both' | None, to remove
         edge ticks on the y-axis.
+
+    minor_x : bool, optional
+        Whether to draw minor ticks on the x-axis. Switching them off (e.g.
+        for plots saved as raster images, where they are hardly visible) saves
+        the cost of computing their location.
+
+    minor_y : bool, optional
+        Whether to draw minor ticks on the y-axis.
     """ 
 
     if which.lower() == 'both' or which.lower() == 'x':
-        ax.xaxis.major_locations = plticker.MaxNLocator(nbins=n_x, prune=prune_x) 
-        ax.xaxis.set_major_locator(ax.xaxis.major_locations)
-
-        ax.xaxis.minor_locations = plticker.AutoMinorLocator(2)
-        ax.xaxis.set_minor_locator(ax.xaxis.minor_locations)
+        ax.xaxis.set_major_locator(plticker.MaxNLocator(nbins=n_x, prune=prune_x))
+        if minor_x:
+            ax.xaxis.set_minor_locator(plticker.AutoMinorLocator(2))
+        else:
+            ax.xaxis.set_minor_locator(plticker.NullLocator())
 
     if which.lower() == 'both' or which.lower() == 'y':
-        ax.yaxis.major_locations = plticker.MaxNLocator(nbins=n_y, prune=prune_y) 
-        ax.yaxis.set_major_locator(ax.yaxis.major_locations)
+        ax.yaxis.set_major_locator(plticker.MaxNLocator(nbins=n_y, prune=prune_y))
+        if minor_y:
+            ax.yaxis.set_minor_locator(plticker.AutoMinorLocator(2))
+        else:
+            ax.yaxis.set_minor_locator(plticker.NullLocator())
 
-        ax.yaxis.minor_locations = plticker.AutoMinorLocator(2)
-        ax.yaxis.set_minor_locator(ax.yaxis.minor_locations)
+def _linear_match(ID_long, ID_short):
+    """ 
+    Match two sorted arrays of integer IDs with a single merge-like sweep.
+
+    Each run of equal IDs in `ID_short` is matched once, by its first
+    element, with the last element of the corresponding run in `ID_long`.
+    When a pointer has to skip more than one element the skip is done by
+    bisection, so that matching a short list against a much longer one does
+    not require visiting all the elements of the latter.
+
+    Parameters
+    ----------
+    ID_long : numpy array int
+        Sorted array of IDs.
+
+    ID_short : numpy array int
+        Sorted array of IDs.
+
+    Returns
+    -------
+    i_long : numpy array int
+        Indices of the matched elements in `ID_long`.
+
+    i_short : numpy array int
+        Indices of the matched elements in `ID_short`.
+    """
+
+    n_long = len(ID_long)
+    n_short = len(ID_short)
+    n_max = min(n_long, n_short)
+    i_long = np.empty(n_max, dtype=np.int64)
+    i_short = np.empty(n_max, dtype=np.int64)
+
+    i = 0
+    j = 0
+    n = 0
+    while i < n_long and j < n_short:
+        if ID_long[i] == ID_short[j]:
+            # Match the last duplicate in ID_long, and skip the duplicates in
+            # ID_short
+            while i+1 < n_long and ID_long[i+1] == ID_long[i]:
+                i += 1
+            i_long[n] = i
+            i_short[n] = j
+            n += 1
+            while j < n_short and ID_short[j] == ID_long[i]:
+                j += 1
+            i += 1
+        elif ID_long[i] < ID_short[j]:
+            # Check the next position first, since IDs are often
+            # consecutive, and only otherwise bisect the rest of the array
+            i += 1
+            if i < n_long and ID_long[i] < ID_short[j]:
+                i += np.searchsorted(ID_long[i:], ID_short[j])
+        else:
+            j += 1
+            if j < n_short and ID_short[j] < ID_long[i]:
+                j += np.searchsorted(ID_short[j:], ID_long[i])
+
+    return i_long[:n], i_short[:n]
+
+if njit is not None:
+    _linear_match = njit(cache=True)(_linear_match)
 
 def match_ID(ID_list_1, ID_list_2, sorted=False, ignore_string=None):
     """ 
@@ -453,6 +857,11 @@ def match_ID(ID_list_1, ID_list_2, sorted=False, ignore_string=None):
     indices_2 : numpy array int
         Array of indices such as `ID_list_1`[indices_1] = `ID_list_2`[indices_2]
 
+    Notes
+    -----
+    If an ID appears more than once in the longer catalogue, it is matched
+    with its last occurrence. If it appears more than once in the shorter
+    catalogue, only its first occurrence is matched.
     """
 
     # Firstly, check weather ID_list_1 is longer than ID_list_2 or viceversa
@@ -460,74 +869,206 @@ def match_ID(ID_list_1, ID_list_2, sorted=False, ignore_string=None):
     n2 = len(ID_list_2)
 
     if n1 >= n2:
-        ID_long = np.array(ID_list_1)
+        ID_long = np.asarray(ID_list_1)
         n_long = n1
-        ID_short = np.array(ID_list_2)
+        ID_short = np.asarray(ID_list_2)
         n_short = n2
     else:
-        ID_long = np.array(ID_list_2)
+        ID_long = np.asarray(ID_list_2)
         n_long = n2
-        ID_short = np.array(ID_list_1)
+        ID_short = np.asarray(ID_list_1)
         n_short = n1
 
-    is_int = False
-    sort_long = range(n_long)
-    sort_short = range(n_short)
+    # Nothing to match if either catalogue is empty
+    if n_short == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
     if issubclass(ID_long.dtype.type, np.integer) and issubclass(ID_short.dtype.type, np.integer):
-        is_int = True
-        if not sorted:
-            # Sort the two arrays and get the indices
-            sort_long = np.argsort(ID_long)
-            sort_short = np.argsort(ID_short)
+        if sorted:
+            sorted_long = ID_long
+            sorted_short = ID_short
+        else:
+            # Sort the two arrays and get the indices (a stable sort keeps
+            # duplicate IDs in their original order)
+            sort_long = np.argsort(ID_long, kind='mergesort')
+            sort_short = np.argsort(ID_short, kind='mergesort')
+            sorted_long = ID_long[sort_long]
+            sorted_short = ID_short[sort_short]
+
+        if njit is not None:
+            # Both arrays are now sorted, so a single linear sweep over the
+            # two of them finds all the matches (a single int64 signature
+            # avoids recompiling the kernel for each integer type)
+            i_long, i_short = _linear_match(
+                    np.ascontiguousarray(sorted_long, dtype=np.int64),
+                    np.ascontiguousarray(sorted_short, dtype=np.int64))
+        else:
+            # Locate all the (sorted) short IDs in the sorted long array at
+            # once, at the last duplicate, then keep only the positions where
+            # the IDs actually coincide, and the first of duplicate short IDs
+            sorted_long = np.ascontiguousarray(sorted_long)
+            i1 = sorted_long.searchsorted(sorted_short, side='right') - 1
+            i1 = np.maximum(i1, 0)
+            hit = sorted_long[i1] == sorted_short
+            hit[1:] &= sorted_short[1:] != sorted_short[:-1]
+
+            i_long = i1[hit]
+            i_short = np.nonzero(hit)[0]
+
+        if sorted:
+            match_indx_long = i_long
+            match_indx_short = i_short
+        else:
+            match_indx_long = sort_long[i_long]
+            match_indx_short = sort_short[i_short]
     else:
         ID_long = np.array(ID_long, dtype=str)
         ID_short = np.array(ID_short, dtype=str)
 
-    match_indx_long = np.full(n_long, -1, dtype=np.int)
-    match_indx_short = np.full(n_short, -1, dtype=np.int)
-    mask_long = np.zeros(n_long, dtype=bool)
+        if ignore_string is None:
+            normalize = lambda ID: ID
+        elif isinstance(ignore_string, re.compile('').__class__):
+            normalize = lambda ID: ignore_string.sub('', ID)
+        else:
+            normalize = lambda ID: ID.replace(ignore_string, '')
 
-    for i in range(n_short):
+        # Hash the (normalized) IDs of the long catalogue, so that each ID of
+        # the short one is matched with a single look-up rather than by
+        # scanning the whole long catalogue. Duplicate IDs keep their last
+        # position.
+        lookup = dict()
+        for j in range(n_long):
+            lookup[normalize(ID_long[j])] = j
 
-        if is_int:
-            i1 = bisect_left(ID_long[sort_long], ID_short[sort_short[i]])
+        # For each element of the short catalogue, index of the matching
+        # element of the long one (-1 if there is no match). Each ID is
+        # removed once matched, so that duplicates in the short catalogue are
+        # only matched once.
+        match_indx_long = np.full(n_short, -1, dtype=np.intp)
 
-            if i1 < n_long:
-                if ID_long[sort_long[i1]] == ID_short[sort_short[i]]:
-                    match_indx_long[i1] = sort_long[i1]
-                    match_indx_short[i] = sort_short[i]
-        else:
-            for j in range(n_long):
-                if mask_long[j]:
-                    continue
-
-                if ignore_string is not None:
-                    if isinstance(ignore_string, re.compile('').__class__):
-                        ID_l = ignore_string.sub('', ID_long[j])
-                        ID_s = ignore_string.sub('', ID_short[i])
-                    else:
-                        ID_l = ID_long[j].replace(ignore_string, '')
-                        ID_s = ID_short[i].replace(ignore_string, '')
-                else:
-                    ID_l = ID_long[j]
-                    ID_s = ID_short[i]
-
-                if ID_l == ID_s:
-                    match_indx_long[i] = j
-                    match_indx_short[i] = i
-                    mask_long[j] = True
+        for i in range(n_short):
+            match_indx_long[i] = lookup.pop(normalize(ID_short[i]), -1)
+
+        match_indx_short = np.flatnonzero(match_indx_long >= 0)
+        match_indx_long = match_indx_long[match_indx_short]
 
     if n1 >= n2:
-        indices_1 = match_indx_long[match_indx_long >= 0]
-        indices_2 = match_indx_short[match_indx_short >= 0]
+        indices_1 = match_indx_long
+        indices_2 = match_indx_short
     else:
-        indices_1 = match_indx_short[match_indx_short >= 0]
-        indices_2 = match_indx_long[match_indx_long >= 0]
+        indices_1 = match_indx_short
+        indices_2 = match_indx_long
 
     return indices_1, indices_2
 
 
-def weighted_avg_and_std(values, weights):
+class IDMatcher(object):
+    """ 
+    Match many catalogues against the same reference catalogue of IDs.
+
+    The reference IDs are sorted only once, when first needed, so that each
+    call to `match` only costs a binary search of the query IDs.
+
+    Parameters
+    ----------
+    ID_ref : numpy array
+        The IDs of the reference catalogue.
+
+    Notes
+    -----
+    As in `match_ID`, integer IDs are compared as such, while any other
+    combination of types is compared after converting both sides to strings.
+    If an ID appears more than once in the reference catalogue, it is matched
+    with its last occurrence. If it appears more than once in a query
+    catalogue, only its first occurrence is matched.
+    """
+
+    def __init__(self, ID_ref):
+
+        self.ID_ref = np.asarray(ID_ref)
+
+        # Sorting indices and sorted reference IDs, for integer and/or string
+        # comparison, computed on first use
+        self._sorted = dict()
+
+    def _sorted_ref(self, as_str):
+
+        if as_str not in self._sorted:
+            ID_ref = np.array(self.ID_ref, dtype=str) if as_str else self.ID_ref
+            order = np.argsort(ID_ref, kind='mergesort')
+            self._sorted[as_str] = (order, ID_ref[order])
+
+        return self._sorted[as_str]
+
+    def match(self, ID_query):
+        """ 
+        Match the IDs of a catalogue with the reference ones.
+
+        Parameters
+        ----------
+        ID_query : numpy array
+            The IDs of the catalogue to match.
+
+        Returns
+        -------
+        indices_ref : numpy array int
+            Array of indices such as `ID_ref`[indices_ref] = `ID_query`[indices_query]
+
+        indices_query : numpy array int
+            Array of indices such as `ID_ref`[indices_ref] = `ID_query`[indices_query]
+        """
+
+        ID_query = np.asarray(ID_query)
+
+        if len(self.ID_ref) == 0 or len(ID_query) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+        as_str = not (issubclass(self.ID_ref.dtype.type, np.integer) and
+                issubclass(ID_query.dtype.type, np.integer))
+
+        if as_str:
+            ID_query = np.array(ID_query, dtype=str)
+
+        order, sorted_ref = self._sorted_ref(as_str)
+
+        # Locate the query IDs in the (stably) sorted reference ones at the
+        # last duplicate, and keep only the positions where the IDs coincide
+        i1 = sorted_ref.searchsorted(ID_query, side='right') - 1
+        i1 = np.maximum(i1, 0)
+        hit = sorted_ref[i1] == ID_query
+
+        # Only the first occurrence of duplicate query IDs is matched
+        first = np.zeros(len(ID_query), dtype=bool)
+        first[np.unique(ID_query, return_index=True)[1]] = True
+        hit &= first
+
+        return order[i1[hit]], np.nonzero(hit)[0]
+
+def match_ID_many(ID_ref, ID_lists):
+    """ 
+    Match the IDs of several catalogues with those of a reference catalogue.
+
+    Parameters
+    ----------
+    ID_ref : numpy array
+        The IDs of the reference catalogue.
+
+    ID_lists : list of numpy arrays
+        The IDs of the catalogues to be matched with the reference one.
+
+    Returns
+    -------
+    list of tuples
+        For each element of `ID_lists`, the pair of index arrays
+        (indices_ref, indices_query) returned by `IDMatcher.match`.
+    """
+
+    matcher = IDMatcher(ID_ref)
+
+    return [matcher.match(ID_list) for ID_list in ID_lists]
+
+
+def weighted_avg_and_std(values, weights, dtype=np.float64, fastpath=True):
     """
     Return the weighted average and standard deviation.
 
@@ -537,7 +1078,19 @@ def weighted_avg_and_std(values, weights):
         Contains the value of the parameter.
 
     weights : Numpy ndarray
-        Contains the weights. Must have same shape as values.
+        Contains the weights. Must have same shape as values. If None, all
+        values have the same weight.
+
+    dtype : Numpy dtype, optional
+        Type used to accumulate the weighted sums. The input arrays are not
+        converted to this type, so that e.g. float32 arrays can be used
+        without making float64 copies of them. Inputs of a wider type (e.g.
+        float64 values with a float32 `dtype`) are cast with 'same_kind'
+        casting.
+
+    fastpath : bool, optional
+        If True, check whether all weights are equal, in which case the
+        (faster) unweighted mean and standard deviation are computed.
 
     Returns
     -------
@@ -548,10 +1101,163 @@ def weighted_avg_and_std(values, weights):
         The weighted standard deviation of the input values.
     """
 
-    average = np.average(values, weights=weights)
-    variance = np.average((values-average)**2, weights=weights)  # Fast and numerically precise
+    values = np.asarray(values)
+
+    if weights is not None:
+        weights = np.asarray(weights)
+        uniform = fastpath and weights.size > 0 and weights.flat[0] != 0 \
+                and np.ptp(weights) == 0
+
+    if weights is None or uniform:
+        return (float(values.mean(dtype=dtype)), float(values.std(dtype=dtype)))
+
+    if values.ndim != 1 or weights.ndim != 1:
+        average = np.average(values, weights=weights)
+        variance = np.average((values-average)**2, weights=weights)  # Fast and numerically precise
+
+        return (float(average), math.sqrt(variance))
+
+    sum_w = weights.sum(dtype=dtype)
+    if sum_w == 0:
+        raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+
+    average = np.einsum('i,i->', weights, values, dtype=dtype, casting='same_kind') / sum_w
+
+    # The variance is computed from the deviations from the mean, rather than
+    # as <x^2> - <x>^2, to avoid catastrophic cancellation. einsum fuses the
+    # products and the sum, so no (values-average)**2 temporary is created.
+    # The deviations are kept in the (floating point) type of the input values
+    residual = np.subtract(values, average,
+            dtype=np.result_type(values.dtype, np.float32))
+    variance = np.einsum('i,i,i->', weights, residual, residual, dtype=dtype,
+            casting='same_kind') / sum_w
+
+    return (float(average), math.sqrt(variance))
+
 
-    return (average, np.sqrt(variance))
+def fast_weighted_kde(data, weights=None, nbins=1024):
+    """ 
+    Compute a (weighted) Gaussian kernel density estimate of 1D data by
+    binning the data and convolving the histogram with the kernel via FFT.
+
+    Parameters
+    ----------
+    data : numpy array
+        The data points. Single precision arrays are used without being
+        converted to double precision.
+
+    weights : numpy array, optional
+        The weights of the data points. By default all points have the same
+        weight.
+
+    nbins : int, optional
+        Number of bins of the grid over which the KDE is computed.
+
+    Returns
+    -------
+    pdf : `scipy.interpolate.interp1d`
+        The KDE, i.e. a callable returning the probability density at any
+        given point(s).
+
+    Notes
+    -----
+    The bandwidth is chosen, as in `dependencies.WeightedKDE.gaussian_kde`,
+    with Scott's rule applied to the Kish effective sample size. The cost is
+    O(nbins log(nbins)), rather than O(N*M) for the direct evaluation of the
+    KDE of N data points at M locations.
+    """ 
+
+    x_grid, pdf_grid = _weighted_kde_grid(data, weights, nbins)
+
+    return interp1d(x_grid, pdf_grid, bounds_error=False, fill_value=0.)
+
+
+def _weighted_kde_grid(data, weights, nbins):
+    """ 
+    Compute the KDE of `fast_weighted_kde`, returning the grid over which it
+    is evaluated and its values over the grid (both 1D arrays).
+    """ 
+
+    data, weights = _kde_input(np.ravel(data), weights)
+
+    x_grid, pdf_grid = _binned_kde(data[np.newaxis, :], weights, nbins)
+
+    return x_grid[0], pdf_grid[0]
+
+
+def _kde_input(data, weights):
+    """ 
+    Check the data (1D, or 2D with one set of data per row) and weights of a
+    KDE, returning the data as floating point numbers and the normalized
+    weights.
+    """ 
+
+    # Single precision data are binned as they are, without double
+    # precision copies; only non floating point data are converted
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float64)
+    if not data.shape[-1] > 1:
+        raise ValueError("`data` input should have multiple elements.")
+
+    if weights is None:
+        weights = np.ones(data.shape[-1], dtype=data.dtype)
+    weights = np.ravel(weights)
+    weights = weights / weights.sum(dtype=np.float64)
+
+    return data, weights
+
+
+def _binned_kde(data, weights, nbins):
+    """ 
+    Compute the Gaussian KDEs of the rows of `data`, sharing the same
+    (normalized) `weights`, over a regular grid of `nbins` points per row.
+    The histograms of all rows are built with a single `np.bincount`, and
+    convolved with their kernels with a single FFT along the rows.
+
+    Returns
+    -------
+    x_grid : 2D numpy array
+        The grid of each row.
+
+    pdf_grid : 2D numpy array
+        The KDE of each row, evaluated over its grid.
+    """ 
+
+    n_rows = data.shape[0]
+
+    # Bandwidth from the (bias-corrected) weighted variance and the effective
+    # sample size
+    sum_w2 = np.sum(weights**2)
+    mean = np.dot(data, weights)
+    variance = np.dot((data-mean[:, np.newaxis])**2, weights) / (1.-sum_w2)
+    bw = np.sqrt(variance) * (1./sum_w2)**(-1./5)
+    if not np.all(bw > 0.):
+        raise ValueError("Cannot compute the KDE of data with zero variance.")
+
+    # Bin the data over a range extending well into the tails of the kernel
+    lo = np.min(data, axis=1) - 4.*bw
+    hi = np.max(data, axis=1) + 4.*bw
+    dx = (hi-lo) / nbins
+
+    bins = ((data-lo[:, np.newaxis]) / dx[:, np.newaxis]).astype(np.intp)
+    np.clip(bins, 0, nbins-1, out=bins)
+    bins += (np.arange(n_rows)*nbins)[:, np.newaxis]
+
+    counts = np.bincount(bins.ravel(), weights=np.tile(weights, n_rows),
+            minlength=n_rows*nbins).reshape(n_rows, nbins)
+
+    x_grid = lo[:, np.newaxis] + dx[:, np.newaxis]*(np.arange(nbins)+0.5)
+
+    # Convolve the histograms with the Gaussian kernels, whose Fourier
+    # transforms are known analytically. The histograms are zero-padded to
+    # twice their length to avoid wrap-around effects.
+    freq = np.fft.rfftfreq(2*nbins)[np.newaxis, :] / dx[:, np.newaxis]
+    kernel_ft = np.exp(-0.5*(2.*np.pi*freq*bw[:, np.newaxis])**2)
+    pdf_grid = np.fft.irfft(np.fft.rfft(counts, 2*nbins, axis=1)*kernel_ft,
+            2*nbins, axis=1)[:, :nbins] / dx[:, np.newaxis]
+    np.clip(pdf_grid, 0., None, out=pdf_grid)
+
+    return x_grid, pdf_grid
 
 
 def prepare_violin_plot(data, 
@@ -559,7 +1265,36 @@ def prepare_violin_plot(data,
         min_x=None,
         max_x=None,
         nXgrid=100,
-        max_interval=99.7):
+        max_interval=99.7,
+        return_pdf_median=False):
+    """ 
+    Compute, through a weighted KDE, the quantities needed to draw the
+    "violin" plot of a set of data.
+
+    Parameters
+    ----------
+    return_pdf_median : bool, optional
+        If True, also return the (normalized) PDF at the median.
+
+    Returns
+    -------
+    pdf : `scipy.interpolate.interp1d`
+        The KDE, as returned by `fast_weighted_kde`.
+
+    pdf_norm : float
+        The integral of the KDE over [min_x, max_x].
+
+    median : float
+        The median of the PDF.
+
+    x_violin, y_violin : numpy arrays
+        The x values and (normalized) PDF of the violin.
+
+    pdf_median : float
+        The (normalized) PDF at the median, i.e. pdf(median)/pdf_norm, read
+        from the grid of the violin. Only returned if `return_pdf_median` is
+        True.
+    """
 
     if min_x is None:
         min_x = np.min(data) 
@@ -568,16 +1303,74 @@ def prepare_violin_plot(data,
         max_x = np.max(data) 
 
     # Compute the marginal PDF through a weighted KDE
-    if weights is not None:
-        pdf = WeightedKDE.gaussian_kde(data, weights=weights)
-    else:
-        pdf = WeightedKDE.gaussian_kde(data)
+    x_kde, pdf_kde = _weighted_kde_grid(data, weights, 1024)
+    pdf = interp1d(x_kde, pdf_kde, bounds_error=False, fill_value=0.)
+
+    return (pdf,) + _violin_plot_from_kde(x_kde, pdf_kde, min_x, max_x,
+            nXgrid, max_interval, return_pdf_median)
+
+
+def prepare_violin_plot_batch(data,
+        weights=None,
+        nXgrid=100,
+        max_interval=99.7,
+        nbins=1024,
+        return_pdf_median=False):
+    """ 
+    Same as `prepare_violin_plot`, for each row of `data`, with the KDEs of
+    all rows computed together.
+
+    Parameters
+    ----------
+    data : 2D numpy array
+        Contains the data, one row per violin plot.
+
+    weights : numpy array, optional
+        Contains the weights of the data points, shared among all the rows.
+
+    return_pdf_median : bool, optional
+        If True, also return the (normalized) PDF at the median.
+
+    Returns
+    -------
+    pdf, pdf_norm, median, x_violin, y_violin(, pdf_median) : lists
+        The outputs of `prepare_violin_plot` for each row. If
+        `return_pdf_median` is True the KDEs are not wrapped into
+        interpolating functions, and `pdf` is a list of None.
+    """
+
+    data, weights = _kde_input(np.atleast_2d(data), weights)
+
+    x_kde, pdf_kde = _binned_kde(data, weights, nbins)
+
+    min_x = np.min(data, axis=1)
+    max_x = np.max(data, axis=1)
+
+    violins = list()
+    for i in range(data.shape[0]):
+        if return_pdf_median:
+            pdf = None
+        else:
+            pdf = interp1d(x_kde[i], pdf_kde[i], bounds_error=False, fill_value=0.)
+        violins.append((pdf,) + _violin_plot_from_kde(x_kde[i], pdf_kde[i],
+            min_x[i], max_x[i], nXgrid, max_interval, return_pdf_median))
+
+    return [list(output) for output in zip(*violins)]
+
+
+def _violin_plot_from_kde(x_kde, pdf_kde, min_x, max_x, nXgrid, max_interval,
+        return_pdf_median=False):
+    """ 
+    Compute the outputs of `prepare_violin_plot`, except the KDE itself, from
+    the grid `x_kde` over which the KDE has been computed and its values
+    `pdf_kde`.
+    """ 
 
     # Build a grid of value over which computing the actual PDF from its KDE
     x_grid = np.linspace(min_x, max_x, nXgrid)
 
-    # Compute the PDF
-    pdf_grid = np.array(pdf(x_grid))
+    # Compute the PDF, by linear interpolation of the KDE grid
+    pdf_grid = np.interp(x_grid, x_kde, pdf_kde, left=0., right=0.)
 
     # ******************************************************************
     # NB: in this case it is correct to integrate the pdf, and not just to sum,
@@ -595,17 +1388,15 @@ def prepare_violin_plot(data,
     cumul_pdf = cumtrapz(pdf_grid, x_grid, initial=0.)
     cumul_pdf /= cumul_pdf[-1]
 
-    # Get the interpolant of the cumulative PDF
-    f_interp = interp1d(cumul_pdf, x_grid)
-
     # Compute the limits over which you will plot the "violin", for
-    # instance showing only the cumulative PDF up to +/- 3 sigma
+    # instance showing only the cumulative PDF up to +/- 3 sigma, and the
+    # median, which corresponds to a cumulative probability = 0.5, by
+    # interpolating the cumulative PDF
     intv = 0.5*(100.-max_interval)/100.
-    lims = f_interp([intv,1.-intv])
-    prob_lims = pdf(lims) / pdf_norm
+    lims = np.interp([intv, 1.-intv], cumul_pdf, x_grid)
+    prob_lims = np.interp(lims, x_kde, pdf_kde, left=0., right=0.) / pdf_norm
 
-    # The median corresponds to a cumulative probability = 0.5
-    median = f_interp(0.5)
+    median = np.interp(0.5, cumul_pdf, x_grid)
 
     i1 = bisect_left(x_grid, lims[0])
     i2 = bisect_left(x_grid, lims[1])
@@ -615,4 +1406,9 @@ def prepare_violin_plot(data,
     y_violin = np.concatenate(([prob_lims[0]], pdf_grid[i1+1:i2], [prob_lims[1]]))
 
 
-    return pdf, pdf_norm, median, x_violin, y_violin
+    if return_pdf_median:
+        # PDF at the median, from the grid
+        pdf_median = np.interp(median, x_grid, pdf_grid)
+        return pdf_norm, median, x_violin, y_violin, pdf_median
+
+    return pdf_norm, median, x_violin, y_violin
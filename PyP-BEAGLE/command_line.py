@@ -235,20 +235,24 @@ def main():
                 pool.map(my_spectrum.plot_marginal, IDs, file_names)
 
             if has_photometry:
-                pool.map(my_photometry.plot_marginal, IDs)
+                my_photometry.plot_many(IDs, n_proc=args.n_proc)
 
             if has_spec_indices and args.line_labels_json:
                 pool.map(my_spec_indices.plot_line_fluxes, IDs)
         else:
-            for i, ID in enumerate(IDs):
-                if has_spectra:
-                    my_spectrum.plot_marginal(ID, file_names[i])
+            try:
+                for i, ID in enumerate(IDs):
+                    if has_spectra:
+                        my_spectrum.plot_marginal(ID, file_names[i])
 
-                if has_photometry:
-                    my_photometry.plot_marginal(ID)
+                    if has_photometry:
+                        my_photometry.plot_marginal(ID)
 
-                if has_spec_indices and args.line_labels_json:
-                    my_spec_indices.plot_line_fluxes(ID)
+                    if has_spec_indices and args.line_labels_json:
+                        my_spec_indices.plot_line_fluxes(ID)
+            finally:
+                if has_photometry:
+                    my_photometry.close_figures()
 
     # Plot the triangle plot
     if args.plot_triangle:
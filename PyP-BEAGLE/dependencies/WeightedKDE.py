@@ -3,6 +3,25 @@
 import numpy as np
 from scipy.spatial.distance import cdist
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _weighted_gauss_kde(grid, data, weights, inv_bw):
+        """Sum of the (unnormalised) weighted Gaussian kernels centred on the
+        1-D `data`, evaluated at each point of `grid`."""
+        result = np.empty(grid.shape[0])
+        for i in prange(grid.shape[0]):
+            total = 0.
+            for j in range(data.shape[0]):
+                z = (grid[i] - data[j]) * inv_bw
+                total += weights[j] * np.exp(-0.5 * z * z)
+            result[i] = total
+        return result
+
 class gaussian_kde(object):
     """Representation of a kernel-density estimate using Gaussian kernels.
 
@@ -189,10 +208,18 @@ class gaussian_kde(object):
                     self.d)
                 raise ValueError(msg)
 
-        # compute the normalised residuals
-        chi2 = cdist(points.T, self.dataset.T, 'mahalanobis', VI=self.inv_cov) ** 2
-        # compute the pdf
-        result = np.sum(np.exp(-.5 * chi2) * self.weights, axis=1) / self._norm_factor
+        if self.d == 1 and njit is not None:
+            # JIT-compiled pairwise sum for univariate data
+            result = _weighted_gauss_kde(
+                    np.ascontiguousarray(points[0], dtype=np.float64),
+                    np.ascontiguousarray(self.dataset[0], dtype=np.float64),
+                    np.ascontiguousarray(self.weights, dtype=np.float64),
+                    np.sqrt(self.inv_cov[0, 0])) / self._norm_factor
+        else:
+            # compute the normalised residuals
+            chi2 = cdist(points.T, self.dataset.T, 'mahalanobis', VI=self.inv_cov) ** 2
+            # compute the pdf
+            result = np.sum(np.exp(-.5 * chi2) * self.weights, axis=1) / self._norm_factor
 
         return result
 